@@ -6,17 +6,36 @@ This script automatically rebases a svn repository.
 See README for details.
 '''
 
+import bisect
 import cPickle
 import os
 import optparse
+import Queue
+import shutil
 import subprocess
 import sys
 import re
+import threading
+import time
+import urllib
 from xml.etree import ElementTree
 
 
 STATE_FILENAME = 'svn_rebase.state'
 
+HOOK_EVENTS = ('pre-merge', 'post-merge', 'post-commit', 'on-conflict')
+
+# number of threads running the post-commit hooks
+HOOK_WORKERS = 4
+
+# hooks taking longer than this (in seconds) are reported
+SLOW_HOOK = 10
+
+# the log entries of each source fetched by get_source_revisions, e.g.
+# {source: {revision: (author, message, paths)}}, paths is None until
+# cache_changed_paths fetches them
+log_cache = {}
+
 manual_commit_message = ('Use "svn commit -F commit_message" to commit '
         'after the conflicts are resolved')
 
@@ -39,13 +58,154 @@ def call(cmd):
         raise CallError
     return stdout
 
-def save_state(source, revisions=None, destination=None, auto_commit=True):
+
+class Hooks(object):
+    '''
+    Hooks called on the events of the rebasing process with (event, source,
+    revisions, message, committed), committed being the revision number of
+    the new commit for post-commit hooks and None otherwise.  The post-commit
+    hooks run in a pool of threads, the rebase only waits for them in
+    `shutdown`.  The other hooks run before the rebase carries on.  A hook
+    that fails or is slow is reported, it does not stop the rebase.
+    '''
+
+    def __init__(self, commands=None, workers=HOOK_WORKERS, slow=SLOW_HOOK):
+        '''
+        :Parameters:
+          - `commands`: list of str, shell commands to run as hooks, e.g.
+            ['post-commit:./notify.sh']
+        '''
+        self.hooks = dict((event, []) for event in HOOK_EVENTS)
+        self.commands = []
+        self.workers = workers
+        self.slow = slow
+        self.queue = Queue.Queue()
+        self.threads = []
+        # the hooks being called, {id: (event, name, revisions, start)}
+        self.running = {}
+        self.lock = threading.Lock()
+        for command in commands or []:
+            self.add_command(command)
+
+    def add(self, event, hook):
+        if event not in self.hooks:
+            raise ValueError('Unknown hook event %s' % event)
+        self.hooks[event].append(hook)
+
+    def add_command(self, command):
+        '''
+        :Parameters:
+          - `command`: str, "EVENT:COMMAND"
+        '''
+        event, shell_command = command.split(':', 1)
+        self.add(event, command_hook(shell_command))
+        self.commands.append(command)
+
+    def run(self, event, source, revisions, message=None, committed=None):
+        for hook in self.hooks[event]:
+            if event == 'post-commit':
+                self._start_workers()
+                self.queue.put((hook, event, source, revisions, message,
+                    committed))
+            else:
+                self._call(hook, event, source, revisions, message,
+                        committed)
+
+    def shutdown(self):
+        '''
+        Wait for the post-commit hooks to finish.  The hooks still running
+        after `slow` seconds are reported, so a hook that hangs is not
+        waited on silently.
+        '''
+        for thread in self.threads:
+            self.queue.put(None)
+        deadline = time.time() + self.slow
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.time()))
+        if [thread for thread in self.threads if thread.isAlive()]:
+            self.lock.acquire()
+            try:
+                running = sorted(self.running.values(), key=lambda r: r[3])
+            finally:
+                self.lock.release()
+            for event, name, label, start in running:
+                sys.stderr.write('Waiting for %s hook %s for r%s, running '
+                        'for %.1fs\n' % (event, name, label,
+                            time.time() - start))
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _start_workers(self):
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self._call(*item)
+
+    def _call(self, hook, event, source, revisions, message, committed):
+        name = getattr(hook, 'command', getattr(hook, '__name__', hook))
+        label = ','.join(str(r) for r in revisions)
+        start = time.time()
+        key = object()
+        self.lock.acquire()
+        self.running[key] = (event, name, label, start)
+        self.lock.release()
+        try:
+            hook(event, source, revisions, message, committed)
+        except Exception, e:
+            sys.stderr.write('%s hook %s failed for r%s: %r\n' % (
+                event, name, label, e))
+        self.lock.acquire()
+        del self.running[key]
+        self.lock.release()
+        elapsed = time.time() - start
+        if elapsed > self.slow:
+            sys.stderr.write('%s hook %s took %.1fs for r%s\n' % (
+                event, name, elapsed, label))
+
+
+def command_hook(command):
+    '''
+    :Returns: a hook running `command` in a shell, with the event, source,
+      revisions, message and committed revision in the environment variables
+      SVN_REBASE_EVENT, SVN_REBASE_SOURCE, SVN_REBASE_REVISIONS,
+      SVN_REBASE_MESSAGE and SVN_REBASE_COMMITTED
+    '''
+    def hook(event, source, revisions, message, committed):
+        env = dict(os.environ)
+        env.update({
+            'SVN_REBASE_EVENT': event,
+            'SVN_REBASE_SOURCE': source,
+            'SVN_REBASE_REVISIONS': ','.join(str(r) for r in revisions),
+            'SVN_REBASE_MESSAGE': (message or '').encode('utf-8'),
+            'SVN_REBASE_COMMITTED': committed is not None and str(committed)
+                or '',
+            })
+        if subprocess.call(command, shell=True, env=env) != 0:
+            raise CallError(command)
+    hook.command = command
+    return hook
+
+def save_state(source, revisions=None, destination=None, auto_commit=True,
+        defer_conflicts=False, deferred=None, coalesce=1, hooks=None):
     f = open(STATE_FILENAME, 'w')
     cPickle.dump({
         'source': source,
         'revisions': revisions,
         'destination': destination,
         'auto_commit': auto_commit,
+        'defer_conflicts': defer_conflicts,
+        'deferred': deferred,
+        'coalesce': coalesce,
+        'hooks': hooks,
         }, f)
     f.close()
 
@@ -61,35 +221,220 @@ def load_state():
 
 remove_state_file = load_state
 
+def _cached_log(revision_range, source):
+    '''
+    :Parameters:
+      - `revision_range`: str, e.g. '1000:1005' or '1000'
+    :Returns: the cached log entries of `source` in `revision_range` as a
+      list of (revision, author, message, paths), or None if they are not
+      cached
+    '''
+    cache = log_cache.get(source)
+    if ':' in revision_range:
+        start, end = [int(r) for r in revision_range.split(':')]
+    else:
+        start = end = int(revision_range)
+    if not cache or start not in cache or end not in cache:
+        return None
+    return [(r,) + cache[r] for r in sorted(cache) if start <= r <= end]
+
 def get_log_message(revision, source):
+    entries = _cached_log(revision, source)
+    if entries:
+        return entries[0][1:3]
     results = call(['svn', 'log', '--xml', '-r', revision, source])
     root = ElementTree.fromstring(results)
     return root.findtext('logentry/author'), root.findtext('logentry/msg')
 
-def svn_merge(source, revision, destination=None, auto_commit=False):
-    call_args = ['svn', 'merge', '--ignore-ancestry', '--accept', 'postpone',
-            '-c', revision, source]
-    if destination is not None:
-        call_args.append(destination)
-    call(call_args)
-    filename = 'commit_message'
-    author, message = get_log_message(revision, source)
+def get_changed_paths(revision, source):
+    '''
+    :Returns: the set of repository paths changed by `revision`, e.g.
+      set(['/trunk/setup.py'])
+    '''
+    entries = _cached_log(revision, source)
+    if entries is not None and None not in [e[3] for e in entries]:
+        paths = set()
+        for entry in entries:
+            paths.update(entry[3])
+        return paths
+    results = call(['svn', 'log', '--xml', '-v', '-r', revision, source])
+    root = ElementTree.fromstring(results)
+    return set(path.text for path in root.findall('logentry/paths/path'))
+
+def cache_changed_paths(revision_range, source):
+    '''
+    Fetch the changed paths of all the revisions of `source` in
+    `revision_range`, e.g. '1000:1005', with one log and keep them in
+    `log_cache`.
+    '''
+    results = call(['svn', 'log', '--xml', '-v', '-r', revision_range,
+        source])
+    _cache_log_entries(source, ElementTree.fromstring(results), verbose=True)
+
+def get_source_path(source):
+    '''
+    :Returns: the path of `source` in its repository, e.g. '/trunk' for
+      'https://svnserver/svn/trunk'
+    '''
+    root = ElementTree.fromstring(call(['svn', 'info', '--xml', source]))
+    url = root.findtext('entry/url')
+    repository = root.findtext('entry/repository/root')
+    return urllib.unquote(url[len(repository):]) or '/'
+
+def relative_paths(paths, source_path):
+    '''
+    :Returns: `paths` relative to `source_path`, leaving out the paths
+      outside of it, e.g. set(['/a.py']) for set(['/trunk/a.py']) and
+      '/trunk'
+    '''
+    prefix = source_path.rstrip('/')
+    relative = set()
+    for path in paths:
+        if path == prefix:
+            relative.add('/')
+        elif path.startswith(prefix + '/'):
+            relative.add(path[len(prefix):])
+    return relative
+
+def paths_overlap(paths, other_paths):
+    '''
+    Two paths overlap if they are the same or one is inside the other.
+    '''
+    for path in paths:
+        for other in other_paths:
+            if (path == other or path.startswith(other.rstrip('/') + '/') or
+                    other.startswith(path.rstrip('/') + '/')):
+                return True
+    return False
+
+def has_conflicts(destination=None):
+    '''
+    :Returns: True if `svn status` shows a conflict in the working copy
+    '''
+    root = ElementTree.fromstring(
+            call(['svn', 'status', '--xml', destination or '.']))
+    for status in root.findall('target/entry/wc-status'):
+        if (status.get('item') == 'conflicted' or
+                status.get('tree-conflicted') == 'true'):
+            return True
+    return False
+
+def svn_revert(destination=None):
+    '''
+    Revert a merge in the working copy, also removing the files it added.
+    '''
+    target = destination or '.'
+    root = ElementTree.fromstring(call(['svn', 'status', '--xml', target]))
+    added = [entry.get('path') for entry in root.findall('target/entry')
+            if entry.find('wc-status').get('item') == 'added']
+    call(['svn', 'revert', '-R', target])
+    # remove the deepest paths first
+    for path in sorted(added, reverse=True):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+def get_log_messages(revision_range, source):
+    '''
+    :Parameters:
+      - `revision_range`: str, e.g. '1000:1005'
+    :Returns: a list of (revision, author, message) in the range
+    '''
+    entries = _cached_log(revision_range, source)
+    if entries is not None:
+        return [entry[:3] for entry in entries]
+    results = call(['svn', 'log', '--xml', '-r', revision_range, source])
+    root = ElementTree.fromstring(results)
+    return [(int(entry.get('revision')), entry.findtext('author'),
+        entry.findtext('msg')) for entry in root.findall('logentry')]
+
+def format_commit_message(author, message, revision):
     message = message.strip()
+    if not re.search('\(([^ ]* )?merge r[^)]*\)$', message):
+        message += ' (%s, merge r%s)' % (author, revision)
+    return message
+
+def _commit(message, auto_commit):
+    '''
+    :Returns: the committed revision, or None if the user commits manually
+    '''
+    filename = 'commit_message'
     f = open(filename, 'w')
     f.write(message.encode('utf-8'))
-    if not re.search('\(([^ ]* )?merge r[^)]*\)$', message):
-        f.write(' (%s, merge r%s)' % (author, revision))
     f.close()
     if auto_commit:
         try:
-            call(['svn', 'commit', '-F', filename])
+            out = call(['svn', 'commit', '-F', filename])
         except CallError:
             print manual_commit_message
             raise SvnConflictException
+        committed = re.search('Committed revision (\d+)\.', out)
+        if committed:
+            return int(committed.group(1))
     else:
         print manual_commit_message
+
+def svn_merge(source, revision, destination=None, auto_commit=False,
+        hooks=None):
+    call_args = ['svn', 'merge', '--ignore-ancestry', '--accept', 'postpone',
+            '-c', revision, source]
+    if destination is not None:
+        call_args.append(destination)
+    call(call_args)
+    author, message = get_log_message(revision, source)
+    message = message.strip()
+    if hooks is not None:
+        hooks.run('post-merge', source, [int(revision)], message)
+    committed = _commit(format_commit_message(author, message, revision),
+            auto_commit)
+    if hooks is not None and auto_commit:
+        hooks.run('post-commit', source, [int(revision)], message, committed)
     return message
 
+def svn_merge_range(source, revisions, destination=None, auto_commit=False,
+        hooks=None):
+    '''
+    Merge consecutive source revisions with one merge and one commit.  The
+    commit message keeps the message and merge marker of every revision.
+
+    :Parameters:
+      - `revisions`: list of int, consecutive in the log of `source`
+    :Returns: the first line of the message of every revision, joined by
+      '; '
+    '''
+    call_args = ['svn', 'merge', '--ignore-ancestry', '--accept', 'postpone',
+            '-r', '%s:%s' % (revisions[0] - 1, revisions[-1]), source]
+    if destination is not None:
+        call_args.append(destination)
+    call(call_args)
+    messages = []
+    originals = []
+    for revision, author, message in get_log_messages(
+            '%s:%s' % (revisions[0], revisions[-1]), source):
+        messages.append(format_commit_message(author, message, revision))
+        originals.append(message.strip())
+    # like svn_merge, hooks get the original messages without the markers
+    message = '\n\n'.join(originals)
+    if hooks is not None:
+        hooks.run('post-merge', source, revisions, message)
+    committed = _commit('\n\n'.join(messages), auto_commit)
+    if hooks is not None and auto_commit:
+        hooks.run('post-commit', source, revisions, message, committed)
+    return '; '.join(m.split('\n')[0] for m in originals)
+
+def merge_is_clean(source, revisions, destination=None):
+    '''
+    Dry run the merge of consecutive source revisions and check that there
+    are no conflicts.
+    '''
+    call_args = ['svn', 'merge', '--dry-run', '--ignore-ancestry',
+            '-r', '%s:%s' % (revisions[0] - 1, revisions[-1]), source]
+    if destination is not None:
+        call_args.append(destination)
+    out = call(call_args)
+    return not re.search('^[ A-Z]{0,3}C ', out, re.M)
+
 def _get_source_revisions(source, stop_on_copy):
     command = ['svn', 'log', '--xml']
     if stop_on_copy:
@@ -97,12 +442,28 @@ def _get_source_revisions(source, stop_on_copy):
     command.append(source)
     return call(command)
 
-def get_source_revisions(source, stop_on_copy=False):
-    out = _get_source_revisions(source, stop_on_copy=stop_on_copy)
-    root = ElementTree.fromstring(out)
+def _cache_log_entries(source, root, verbose=False):
+    '''
+    :Returns: the revisions of the log entries in `root`, which are kept in
+      `log_cache`
+    '''
     rev = []
+    cache = log_cache.setdefault(source, {})
     for entry in root.findall('logentry'):
         rev.append(int(entry.get('revision')))
+        paths = None
+        if verbose:
+            paths = set(path.text for path in entry.findall('paths/path'))
+        cache[rev[-1]] = (entry.findtext('author'), entry.findtext('msg'),
+                paths)
+    return rev
+
+def get_source_revisions(source, stop_on_copy=False):
+    '''
+    Also keeps the log entries of `source` in `log_cache`.
+    '''
+    out = _get_source_revisions(source, stop_on_copy=stop_on_copy)
+    rev = _cache_log_entries(source, ElementTree.fromstring(out))
     if stop_on_copy:
         # the first rev is the copy commit
         rev.pop()
@@ -126,33 +487,207 @@ def parse_revisions(revisions):
             expanded.append(int(r))
     return expanded
 
-def svn_rebase(source, revisions=None, destination=None, auto_commit=True):
-    if call(['svn', 'diff']):
-        raise LocalModificationsException
+def get_revision_run(revisions, source_revisions, coalesce):
+    '''
+    :Parameters:
+      - `revisions`: list of int, the revisions left to merge
+      - `source_revisions`: sorted list of int, all the revisions of the
+        source
+      - `coalesce`: int, maximum length of the run
+    :Returns: the first revisions of `revisions` that are consecutive in
+      `source_revisions`, e.g. [1000, 1002] if 1001 is not a source revision
+    '''
+    run = revisions[:1]
+    i = bisect.bisect_left(source_revisions, revisions[0])
+    for r in revisions[1:coalesce]:
+        i += 1
+        if i >= len(source_revisions) or source_revisions[i] != r:
+            break
+        run.append(r)
+    return run
+
+def _discover_revisions(source, revisions):
     if revisions is None:
-        revisions = get_source_revisions(source, stop_on_copy=True)
+        source_revisions = get_source_revisions(source, stop_on_copy=True)
+        revisions = list(source_revisions)
     else:
         if isinstance(revisions, str):
             revisions = parse_revisions(revisions)
         source_revisions = get_source_revisions(source)
         revisions = list(set(source_revisions).intersection(set(revisions)))
-
+    source_revisions.sort()
     revisions.sort()
+    return source_revisions, revisions
+
+def discover_revisions(sources, selections):
+    '''
+    Fetch the logs of all the sources at the same time.
 
-    while revisions:
-        r = revisions.pop(0)
-        save_state(source, revisions, destination, auto_commit=auto_commit)
-        conflict = False
+    :Parameters:
+      - `sources`: list of str, source urls
+      - `selections`: list of the revisions to merge from each source, None
+        for all the revisions since the source was copied
+    :Returns: a list of (source_revisions, revisions) for each source, both
+      sorted
+    '''
+    results = [None] * len(sources)
+    errors = []
+    def discover(i):
         try:
-            message = svn_merge(source, str(r), destination,
-                    auto_commit=auto_commit)
-            print 'Merged %s (%s)' % (r, message)
-        except SvnConflictException:
-            conflict = True
-        if not auto_commit or conflict:
-            print '"%s --continue" to continue the merge' % sys.argv[0]
+            results[i] = _discover_revisions(sources[i], selections[i])
+        except Exception, e:
+            errors.append(e)
+    threads = [threading.Thread(target=discover, args=(i,))
+            for i in range(len(sources))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+def svn_rebase(source, revisions=None, destination=None, auto_commit=True,
+        defer_conflicts=False, deferred=None, coalesce=1, hooks=None):
+    '''
+    :Parameters:
+      - `source`: str, or a list of str to merge from several sources in
+        revision order
+      - `revisions`: the revisions to merge from `source`, None for all the
+        revisions since it was copied.  A list with the revisions of each
+        source if `source` is a list.
+      - `defer_conflicts`: bool, revert conflicting revisions and carry on
+        with the revisions that do not touch the same paths
+      - `deferred`: list of revisions deferred in a previous run, these are
+        not deferred again
+      - `coalesce`: int, merge up to this many consecutive revisions which
+        merge cleanly with one merge and one commit
+      - `hooks`: `Hooks` or list of str, see `Hooks`
+    '''
+    if call(['svn', 'diff']):
+        raise LocalModificationsException
+    if isinstance(source, basestring):
+        sources = [source]
+        selections = [revisions]
+    else:
+        sources = list(source)
+        selections = list(revisions or [])
+        selections += [None] * (len(sources) - len(selections))
+
+    log_cache.clear()
+    discovered = discover_revisions(sources, selections)
+    source_revisions = [d[0] for d in discovered]
+    # (revision, index of the source) in revision order
+    pending = []
+    for i, (_, revs) in enumerate(discovered):
+        pending.extend((r, i) for r in revs)
+    pending.sort()
+
+    deferred = deferred or []
+    # revisions deferred in this run and the paths they touch, relative to
+    # their source so that the paths of all the sources can be compared
+    deferring = []
+    deferred_paths = set()
+    source_paths = {}
+    if not isinstance(hooks, Hooks):
+        hooks = Hooks(hooks)
+
+    def changed_paths(revision_range, i):
+        if i not in source_paths:
+            source_paths[i] = get_source_path(sources[i])
+        return relative_paths(get_changed_paths(revision_range, sources[i]),
+                source_paths[i])
+
+    def save(pending):
+        remaining = [[r for r, i in pending if i == j]
+                for j in range(len(sources))]
+        if isinstance(source, basestring):
+            remaining = remaining[0]
+        save_state(source, remaining, destination,
+                auto_commit=auto_commit, defer_conflicts=defer_conflicts,
+                deferred=deferred + [r for r, i in deferring],
+                coalesce=coalesce, hooks=hooks.commands)
+
+    try:
+        while pending:
+            i = pending[0][1]
+            url = sources[i]
+            head = []
+            for r, j in pending[:coalesce]:
+                if j != i:
+                    break
+                head.append(r)
+            run = get_revision_run(head, source_revisions[i], coalesce)
+            if deferring:
+                for k, r in enumerate(run):
+                    if paths_overlap(changed_paths(str(r), i),
+                            deferred_paths):
+                        run = run[:k]
+                        break
+                if not run:
+                    print 'r%s depends on deferred revisions' % pending[0][0]
+                    break
+            # halve the run until the dry run is clean, so that a conflict
+            # late in the run does not cost a dry run per revision
+            while len(run) > 1 and not merge_is_clean(url, run, destination):
+                run = run[:len(run) // 2]
+            hooks.run('pre-merge', url, run)
+            del pending[:len(run)]
+            save(deferring + pending)
+            if len(run) == 1:
+                merged = str(run[0])
+            else:
+                merged = '%s-%s' % (run[0], run[-1])
+            conflict = False
+            try:
+                if len(run) == 1:
+                    message = svn_merge(url, merged, destination,
+                            auto_commit=auto_commit, hooks=hooks)
+                else:
+                    message = svn_merge_range(url, run, destination,
+                            auto_commit=auto_commit, hooks=hooks)
+                print 'Merged %s (%s)' % (merged, message)
+            except SvnConflictException:
+                conflict = True
+                hooks.run('on-conflict', url, run)
+            # a commit can also fail for reasons other than a conflict, do
+            # not revert and defer a clean merge then
+            if (conflict and defer_conflicts and
+                    not set(run).intersection(deferred) and
+                    has_conflicts(destination)):
+                first = not deferring
+                # record the run before touching the working copy, so that
+                # --continue still merges it if anything below fails
+                deferring.extend((r, i) for r in run)
+                save(deferring + pending)
+                svn_revert(destination)
+                if first:
+                    # from now on the changed paths of every revision are
+                    # needed, fetch them with one log per source
+                    for j in range(len(sources)):
+                        revs = [r for r, k in pending if k == j]
+                        if j == i:
+                            revs = run + revs
+                        if revs:
+                            cache_changed_paths('%s:%s' % (
+                                revs[0], revs[-1]), sources[j])
+                deferred_paths.update(changed_paths(
+                    '%s:%s' % (run[0], run[-1]), i))
+                print 'Deferred %s' % merged
+                continue
+            if not auto_commit or conflict:
+                print '"%s --continue" to continue the merge' % sys.argv[0]
+                sys.exit(1)
+        if deferring:
+            save(deferring + pending)
+            print 'Deferred revisions: %s' % ', '.join(
+                    str(r) for r, i in deferring)
+            print '"%s --continue" to resolve the deferred revisions' % (
+                    sys.argv[0])
             sys.exit(1)
-    remove_state_file()
+        remove_state_file()
+    finally:
+        hooks.shutdown()
 
 def main():
     """Handles the svn rebase command line usage
@@ -161,7 +696,7 @@ def main():
     sysargs = sys.argv[1:]
 
     parser = optparse.OptionParser(
-            usage=('%prog [options] source_url\n\n'
+            usage=('%prog [options] source_url [source_url ...]\n\n'
                 '   or: %prog --continue | --abort'))
 #    parser.add_option('-i', '--interactive',
 #            help=('Make a list of commits which are about to be rebased.  Let'
@@ -177,8 +712,24 @@ def main():
     parser.add_option('-m', '--manual-commit',
             help='After merging a commit, let the user commit manually.',
             action='store_false', dest='auto_commit', default=True)
+    parser.add_option('-D', '--defer-conflicts',
+            help=('Revert a revision that conflicts and keep merging the '
+                'revisions that do not touch the same paths.'),
+            action='store_true', dest='defer_conflicts', default=False)
+    parser.add_option('-C', '--coalesce',
+            help=('Merge up to COALESCE consecutive revisions that merge '
+                'cleanly with one merge and one commit.'),
+            action='store', type='int', dest='coalesce', default=1)
+    parser.add_option('-k', '--hook',
+            help=('Run COMMAND on EVENT, given as EVENT:COMMAND.  EVENT is '
+                'one of %s.  Can be given more than once.' % (
+                    ', '.join(HOOK_EVENTS))),
+            action='append', dest='hooks', metavar='EVENT:COMMAND')
     parser.add_option('-r', '--revisions',
-            help='Revisions to merge', action='store', dest='revisions')
+            help=('Revisions to merge.  Give it once per source url, in the '
+                'same order, to merge from several source urls; an empty '
+                'REVISIONS merges all the revisions of that source url.'),
+            action='append', dest='revisions')
     parser.add_option('-d', '--destination',
             help='Target directory of the merges.', action='store',
             dest='destination')
@@ -190,25 +741,56 @@ def main():
         if not state:
             sys.stderr.write('No rebase in progress?\n')
             sys.exit(1)
-        if options.revisions or options.abort or options.destination or args:
+        if (options.revisions or options.abort or options.destination or
+                options.defer_conflicts or options.coalesce != 1 or
+                options.hooks or args):
             parser.error('option -c / --continue can only be used '
                     'without other options.')
 
     elif options.abort:
-        if options.cont or options.revisions or options.destination or args:
+        if (options.cont or options.revisions or options.destination or
+                options.defer_conflicts or options.coalesce != 1 or
+                options.hooks or args):
             parser.error('option -a / --abort can only be used '
                     'without other options.')
         remove_state_file()
         sys.exit(0)
 
     else:
-        if len(args) != 1:
+        if not args:
             sys.stderr.write('Please specify the source url.\n')
             sys.exit(1)
-        state['source'] = args[0]
-        state['revisions'] = options.revisions
+        revisions = [r or None for r in options.revisions or []]
+        if len(revisions) > len(args):
+            parser.error('option -r / --revisions can only be given once per '
+                    'source url.')
+        for r in revisions:
+            try:
+                if r is not None:
+                    parse_revisions(r)
+            except ValueError:
+                parser.error('option -r / --revisions must be like '
+                        '1000-1005,1008, not %r.' % r)
+        if options.coalesce < 1:
+            parser.error('option -C / --coalesce must be at least 1.')
+        for hook in options.hooks or []:
+            if hook.split(':', 1)[0] not in HOOK_EVENTS or ':' not in hook:
+                parser.error('option -k / --hook must be EVENT:COMMAND with '
+                        'EVENT one of %s.' % ', '.join(HOOK_EVENTS))
+        if options.defer_conflicts and not options.auto_commit:
+            parser.error('option -D / --defer-conflicts cannot be used with '
+                    '-m / --manual-commit.')
+        if len(args) == 1:
+            state['source'] = args[0]
+            state['revisions'] = revisions and revisions[0] or None
+        else:
+            state['source'] = args
+            state['revisions'] = revisions
         state['destination'] = options.destination
         state['auto_commit'] = options.auto_commit
+        state['defer_conflicts'] = options.defer_conflicts
+        state['coalesce'] = options.coalesce
+        state['hooks'] = options.hooks
 
     try:
         svn_rebase(**state)
@@ -4,6 +4,10 @@
 '''Tests for svn_rebase.py
 '''
 
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
 import mock
@@ -20,6 +24,19 @@ class TestSvnRebase(unittest.TestCase):
             'load_state',
             'optparse',
             'remove_state_file',
+            'save_state',
+            'svn_merge',
+            'svn_revert',
+            'get_source_revisions',
+            'get_changed_paths',
+            'svn_merge_range',
+            'merge_is_clean',
+            'get_log_messages',
+            '_commit',
+            'get_log_message',
+            'get_source_path',
+            'cache_changed_paths',
+            'has_conflicts',
             ]
     def setUp(self):
         for var in self.save_and_restore:
@@ -30,11 +47,15 @@ class TestSvnRebase(unittest.TestCase):
         self.options.abort = None
         self.options.destination = None
         self.options.cont = None
+        self.options.defer_conflicts = False
+        self.options.coalesce = 1
+        self.options.hooks = None
         self.args = []
 
     def tearDown(self):
         for var in self.save_and_restore:
             setattr(svn_rebase, var, getattr(self, var))
+        svn_rebase.log_cache.clear()
 
     def test_get_log_message(self):
         log_output = '''<?xml version="1.0"?>
@@ -54,6 +75,193 @@ class TestSvnRebase(unittest.TestCase):
         self.assertEqual(author, u'karen')
         self.assertEqual(message, u'#5099 Change これ\n')
 
+    def test_get_log_messages(self):
+        svn_rebase.call = lambda cmd: '''<?xml version="1.0"?>
+<log>
+<logentry
+   revision="6583">
+<author>karen</author>
+<date>2010-07-21T20:39:32.503726Z</date>
+<msg>Add script to go back one version at a time
+</msg>
+</logentry>
+<logentry
+   revision="6643">
+<author>karen</author>
+<date>2010-07-27T11:14:29.911990Z</date>
+<msg>svn merge tool
+</msg>
+</logentry>
+</log>
+'''
+        self.assertEqual(svn_rebase.get_log_messages('6583:6643', 'source'), [
+            (6583, 'karen', 'Add script to go back one version at a time\n'),
+            (6643, 'karen', 'svn merge tool\n'),
+            ])
+
+    def test_format_commit_message(self):
+        self.assertEqual(
+                svn_rebase.format_commit_message('karen', 'Fix\n', '1000'),
+                'Fix (karen, merge r1000)')
+        self.assertEqual(svn_rebase.format_commit_message('karen',
+            'Fix (karen, merge r900)', '1000'), 'Fix (karen, merge r900)')
+
+    def test_commit(self):
+        svn_rebase.call = lambda cmd: (
+                'Sending        a.py\n'
+                'Transmitting file data .\n'
+                'Committed revision 1234.\n')
+        try:
+            self.assertEqual(svn_rebase._commit(u'message', True), 1234)
+            self.assertEqual(svn_rebase._commit(u'message', False), None)
+        finally:
+            os.remove('commit_message')
+
+    def test_svn_merge_post_commit_hook(self):
+        svn_rebase.call = lambda cmd: ''
+        svn_rebase.get_log_message = lambda revision, source: (
+                'karen', 'Fix\n')
+        svn_rebase._commit = mock.Mock()
+        svn_rebase._commit.return_value = 1234
+        hooks = svn_rebase.Hooks()
+        events = []
+        for event in svn_rebase.HOOK_EVENTS:
+            hooks.add(event, lambda event, source, revisions, message,
+                    committed: events.append((event, revisions, committed)))
+        svn_rebase.svn_merge('source', '5', auto_commit=True, hooks=hooks)
+        hooks.shutdown()
+        self.assertEqual(events, [
+            ('post-merge', [5], None),
+            ('post-commit', [5], 1234),
+            ])
+
+    def test_svn_merge_range(self):
+        calls = []
+        svn_rebase.call = lambda cmd: calls.append(cmd)
+        svn_rebase.get_log_messages = lambda revision_range, source: [
+                (5, 'karen', 'Fix a\n\nDetails\n'),
+                (6, 'karen', 'Fix b (karen, merge r3)\n'),
+                ]
+        svn_rebase._commit = mock.Mock()
+        svn_rebase._commit.return_value = 1234
+        hooks = svn_rebase.Hooks()
+        events = []
+        for event in ('post-merge', 'post-commit'):
+            hooks.add(event, lambda event, source, revisions, message,
+                    committed: events.append((event, message)))
+        message = svn_rebase.svn_merge_range('source', [5, 6], 'dir',
+                auto_commit=True, hooks=hooks)
+        hooks.shutdown()
+        self.assertEqual(message, 'Fix a; Fix b (karen, merge r3)')
+        # hooks get the original messages, like with svn_merge
+        self.assertEqual(events, [
+            ('post-merge', 'Fix a\n\nDetails\n\nFix b (karen, merge r3)'),
+            ('post-commit', 'Fix a\n\nDetails\n\nFix b (karen, merge r3)'),
+            ])
+        self.assertEqual(calls, [['svn', 'merge', '--ignore-ancestry',
+            '--accept', 'postpone', '-r', '4:6', 'source', 'dir']])
+        self.assertEqual(svn_rebase._commit.call_args[0], (
+            'Fix a\n\nDetails (karen, merge r5)\n\n'
+            'Fix b (karen, merge r3)', True))
+
+    def test_merge_is_clean(self):
+        svn_rebase.call = lambda cmd: (
+                "--- Merging r5 through r7 into '.':\n"
+                "U    a.py\n"
+                " U   b.py\n")
+        self.assertTrue(svn_rebase.merge_is_clean('source', [5, 6, 7]))
+        svn_rebase.call = lambda cmd: (
+                "--- Merging r5 through r7 into '.':\n"
+                "U    a.py\n"
+                "C    b.py\n"
+                "Summary of conflicts:\n"
+                "  Text conflicts: 1\n")
+        self.assertFalse(svn_rebase.merge_is_clean('source', [5, 6, 7]))
+
+    def test_hooks(self):
+        svn_rebase.sys = mock.Mock()
+        hooks = svn_rebase.Hooks(workers=2)
+        calls = []
+        def hook(event, source, revisions, message, committed):
+            calls.append((event, source, revisions, message, committed))
+        hooks.add('pre-merge', hook)
+        hooks.add('post-commit', hook)
+        hooks.run('pre-merge', 'source', [1])
+        self.assertEqual(calls, [('pre-merge', 'source', [1], None, None)])
+        self.assertEqual(hooks.threads, [])
+        hooks.run('post-commit', 'source', [1], 'message', 1234)
+        self.assertEqual(len(hooks.threads), 2)
+        hooks.shutdown()
+        self.assertEqual(hooks.threads, [])
+        self.assertEqual(calls[1],
+                ('post-commit', 'source', [1], 'message', 1234))
+        self.assertFalse(svn_rebase.sys.stderr.write.called)
+        self.assertRaises(ValueError, hooks.add, 'post-update', hook)
+
+    def test_hooks_failing_and_slow(self):
+        svn_rebase.sys = mock.Mock()
+        hooks = svn_rebase.Hooks(slow=-1)
+        def failing_hook(event, source, revisions, message, committed):
+            raise svn_rebase.CallError
+        hooks.add('post-commit', failing_hook)
+        hooks.run('post-commit', 'source', [1, 2])
+        hooks.shutdown()
+        messages = [args[0] for args, kwargs in
+                svn_rebase.sys.stderr.write.call_args_list]
+        self.assertEqual(len(messages), 2)
+        self.assertTrue(messages[0].startswith(
+            'post-commit hook failing_hook failed for r1,2'))
+        self.assertTrue(messages[1].startswith(
+            'post-commit hook failing_hook took'))
+
+    def test_hooks_blocking(self):
+        svn_rebase.sys = mock.Mock()
+        hooks = svn_rebase.Hooks(slow=0.05)
+        release = threading.Event()
+        def blocking_hook(event, source, revisions, message, committed):
+            release.wait()
+        hooks.add('post-commit', blocking_hook)
+        hooks.run('post-commit', 'source', [1])
+        # release the hook once shutdown has been waiting for a while
+        timer = threading.Timer(0.3, release.set)
+        timer.start()
+        hooks.shutdown()
+        timer.join()
+        messages = [args[0] for args, kwargs in
+                svn_rebase.sys.stderr.write.call_args_list]
+        self.assertTrue(messages[0].startswith(
+            'Waiting for post-commit hook blocking_hook for r1, running for'))
+        self.assertTrue(messages[1].startswith(
+            'post-commit hook blocking_hook took'))
+        self.assertEqual(hooks.threads, [])
+        self.assertEqual(hooks.running, {})
+
+    def test_command_hook(self):
+        hook = svn_rebase.command_hook(
+                'test "$SVN_REBASE_EVENT:$SVN_REBASE_REVISIONS:'
+                '$SVN_REBASE_COMMITTED" = "post-commit:1,2:1234"')
+        hook('post-commit', 'source', [1, 2], u'message', 1234)
+        self.assertRaises(svn_rebase.CallError,
+                hook, 'post-commit', 'source', [3], None, None)
+
+    def test_hooks_commands(self):
+        hooks = svn_rebase.Hooks(['post-commit:./notify.sh'])
+        self.assertEqual(hooks.commands, ['post-commit:./notify.sh'])
+        self.assertEqual(len(hooks.hooks['post-commit']), 1)
+        self.assertEqual(hooks.hooks['post-commit'][0].command,
+                './notify.sh')
+
+    def test_get_revision_run(self):
+        source_revisions = [1, 2, 3, 5, 6, 8]
+        self.assertEqual(svn_rebase.get_revision_run(
+            [1, 2, 3, 5, 6], source_revisions, 10), [1, 2, 3, 5, 6])
+        self.assertEqual(svn_rebase.get_revision_run(
+            [1, 2, 3, 5, 6], source_revisions, 2), [1, 2])
+        self.assertEqual(svn_rebase.get_revision_run(
+            [2, 5, 6], source_revisions, 10), [2])
+        self.assertEqual(svn_rebase.get_revision_run(
+            [6, 8], source_revisions, 1), [6])
+
     def test_parse_revisions(self):
         self.assertEqual(
                 svn_rebase.parse_revisions(
@@ -92,6 +300,465 @@ class TestSvnRebase(unittest.TestCase):
         self.assertEqual(svn_rebase.get_source_revisions('source'),
                 [6643, 6583, 6546])
 
+    def test_get_changed_paths(self):
+        svn_rebase.call = lambda cmd: '''<?xml version="1.0"?>
+<log>
+<logentry
+   revision="6643">
+<author>karen</author>
+<date>2010-07-27T11:14:29.911990Z</date>
+<paths>
+<path
+   kind=""
+   action="M">/trunk/setup.py</path>
+<path
+   kind=""
+   action="A">/trunk/svn_rebase</path>
+</paths>
+<msg>svn merge tool
+</msg>
+</logentry>
+</log>
+'''
+        self.assertEqual(svn_rebase.get_changed_paths('6643', 'source'),
+                set(['/trunk/setup.py', '/trunk/svn_rebase']))
+
+    def test_log_cache(self):
+        log_output = '''<?xml version="1.0"?>
+<log>
+<logentry
+   revision="6643">
+<author>karen</author>
+<date>2010-07-27T11:14:29.911990Z</date>
+<paths>
+<path
+   kind=""
+   action="M">/trunk/setup.py</path>
+</paths>
+<msg>svn merge tool
+</msg>
+</logentry>
+<logentry
+   revision="6583">
+<author>karen</author>
+<date>2010-07-21T20:39:32.503726Z</date>
+<paths>
+<path
+   kind=""
+   action="A">/trunk/back.py</path>
+</paths>
+<msg>Add script to go back one version at a time
+</msg>
+</logentry>
+</log>
+'''
+        svn_rebase._get_source_revisions = lambda source, stop_on_copy: (
+                log_output)
+        self.assertEqual(svn_rebase.get_source_revisions('source'),
+                [6643, 6583])
+        def call(cmd):
+            raise svn_rebase.CallError
+        svn_rebase.call = call
+        self.assertEqual(svn_rebase.get_log_message('6643', 'source'),
+                ('karen', 'svn merge tool\n'))
+        self.assertEqual(svn_rebase.get_log_messages('6583:6643', 'source'), [
+            (6583, 'karen', 'Add script to go back one version at a time\n'),
+            (6643, 'karen', 'svn merge tool\n'),
+            ])
+        self.assertRaises(svn_rebase.CallError,
+                svn_rebase.get_log_message, '6643', 'other_source')
+        # the changed paths are only fetched by cache_changed_paths
+        self.assertRaises(svn_rebase.CallError,
+                svn_rebase.get_changed_paths, '6583:6643', 'source')
+        commands = []
+        svn_rebase.call = lambda cmd: commands.append(cmd) or log_output
+        svn_rebase.cache_changed_paths('6583:6643', 'source')
+        self.assertEqual(commands, [
+            ['svn', 'log', '--xml', '-v', '-r', '6583:6643', 'source']])
+        svn_rebase.call = call
+        self.assertEqual(svn_rebase.get_changed_paths('6583:6643', 'source'),
+                set(['/trunk/setup.py', '/trunk/back.py']))
+
+    def test_get_source_path(self):
+        svn_rebase.call = lambda cmd: '''<?xml version="1.0"?>
+<info>
+<entry
+   kind="dir"
+   path="f%20b"
+   revision="6643">
+<url>https://svnserver/svn/branches/f%20b</url>
+<repository>
+<root>https://svnserver/svn</root>
+<uuid>8b3a8a5e-2b6f-4f3a-9b8e-0c8f1f7d1c1a</uuid>
+</repository>
+</entry>
+</info>
+'''
+        self.assertEqual(svn_rebase.get_source_path(
+            'https://svnserver/svn/branches/f%20b@6643'), '/branches/f b')
+
+    def test_relative_paths(self):
+        self.assertEqual(svn_rebase.relative_paths(
+            ['/trunk/a.py', '/trunk', '/branches/f/a.py', '/trunkx'],
+            '/trunk'), set(['/a.py', '/']))
+        self.assertEqual(svn_rebase.relative_paths(['/trunk/a.py'], '/'),
+                set(['/trunk/a.py']))
+
+    def test_discover_revisions(self):
+        logs = {
+                'trunk': [10, 8, 5, 3],
+                'branch': [9, 7, 4],
+                }
+        svn_rebase.get_source_revisions = lambda source, stop_on_copy=False: (
+                list(logs[source]))
+        self.assertEqual(svn_rebase.discover_revisions(
+            ['trunk', 'branch'], ['3-5', None]), [
+                ([3, 5, 8, 10], [3, 5]),
+                ([4, 7, 9], [4, 7, 9]),
+                ])
+
+    def test_discover_revisions_error(self):
+        def get_source_revisions(source, stop_on_copy=False):
+            raise svn_rebase.CallError
+        svn_rebase.get_source_revisions = get_source_revisions
+        self.assertRaises(svn_rebase.CallError,
+                svn_rebase.discover_revisions, ['trunk', 'branch'],
+                [None, None])
+
+    def test_paths_overlap(self):
+        self.assertTrue(svn_rebase.paths_overlap(
+            ['/trunk/a.py'], ['/trunk/b.py', '/trunk/a.py']))
+        self.assertTrue(svn_rebase.paths_overlap(
+            ['/trunk/lib/a.py'], ['/trunk/lib']))
+        self.assertTrue(svn_rebase.paths_overlap(
+            ['/trunk/lib'], ['/trunk/lib/a.py']))
+        self.assertFalse(svn_rebase.paths_overlap(
+            ['/trunk/library.py'], ['/trunk/lib']))
+        self.assertFalse(svn_rebase.paths_overlap(['/trunk/a.py'], []))
+
+    def rebase_setup(self, conflicts, changed_paths):
+        svn_rebase.call = lambda cmd: ''
+        svn_rebase.sys = mock.Mock()
+        def sys_exit(*args):
+            raise SystemExit
+        svn_rebase.sys.exit.side_effect = sys_exit
+        svn_rebase.sys.argv = ['svn_rebase']
+        svn_rebase.save_state = mock.Mock()
+        svn_rebase.remove_state_file = mock.Mock()
+        svn_rebase.svn_revert = mock.Mock()
+        svn_rebase.get_source_revisions = lambda source, stop_on_copy=False: (
+                sorted(changed_paths, reverse=True))
+        def get_changed_paths(revision, source):
+            start, end = (revision.split(':') * 2)[:2]
+            paths = set()
+            for r in range(int(start), int(end) + 1):
+                paths.update(changed_paths.get(r, []))
+            return paths
+        svn_rebase.get_changed_paths = get_changed_paths
+        svn_rebase.get_source_path = lambda source: '/trunk'
+        svn_rebase.cache_changed_paths = mock.Mock()
+        svn_rebase.has_conflicts = lambda destination: True
+        self.merged = []
+        def svn_merge(source, revision, destination, auto_commit,
+                hooks=None):
+            if int(revision) in conflicts:
+                raise svn_rebase.SvnConflictException
+            self.merged.append(int(revision))
+            return 'message'
+        svn_rebase.svn_merge = svn_merge
+
+    def test_svn_rebase_defer_conflicts(self):
+        self.rebase_setup([2], {
+            1: set(['/trunk/a.py']),
+            2: set(['/trunk/b']),
+            3: set(['/trunk/c.py']),
+            4: set(['/trunk/b/d.py']),
+            5: set(['/trunk/e.py']),
+            })
+        try:
+            svn_rebase.svn_rebase('source', defer_conflicts=True)
+        except SystemExit:
+            pass
+        # stops on r4 which touches a path of the deferred r2
+        self.assertEqual(self.merged, [1, 3])
+        self.assertTrue(svn_rebase.svn_revert.called)
+        self.assertEqual(svn_rebase.save_state.call_args, (
+            ('source', [2, 4, 5], None),
+            {'auto_commit': True, 'defer_conflicts': True, 'deferred': [2],
+                'coalesce': 1, 'hooks': []}))
+        self.assertFalse(svn_rebase.remove_state_file.called)
+
+    def test_svn_rebase_defer_keeps_run_in_state(self):
+        self.rebase_setup([2], {
+            1: set(['/trunk/a.py']),
+            2: set(['/trunk/b']),
+            3: set(['/trunk/c.py']),
+            4: set(['/trunk/d.py']),
+            })
+        svn_rebase.cache_changed_paths = mock.Mock()
+        svn_rebase.cache_changed_paths.side_effect = svn_rebase.CallError
+        self.assertRaises(svn_rebase.CallError, svn_rebase.svn_rebase,
+                'source', defer_conflicts=True)
+        self.assertEqual(svn_rebase.save_state.call_args[0],
+                ('source', [2, 3, 4], None))
+        self.assertEqual(svn_rebase.save_state.call_args[1]['deferred'], [2])
+
+    def test_svn_rebase_commit_fails_without_conflict(self):
+        self.rebase_setup([2], {
+            1: set(['/trunk/a.py']),
+            2: set(['/trunk/b']),
+            3: set(['/trunk/c.py']),
+            })
+        svn_rebase.has_conflicts = lambda destination: False
+        try:
+            svn_rebase.svn_rebase('source', defer_conflicts=True)
+        except SystemExit:
+            pass
+        # e.g. an out of date working copy, stop instead of reverting
+        self.assertEqual(self.merged, [1])
+        self.assertFalse(svn_rebase.svn_revert.called)
+        self.assertEqual(svn_rebase.save_state.call_args[0],
+                ('source', [3], None))
+
+    def test_svn_revert(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(tmp, 'new'))
+            for path in ('new/a.py', 'b.py', 'c.py'):
+                open(os.path.join(tmp, path), 'w').close()
+            entry = '''<entry
+   path="%s">
+<wc-status
+   props="none"
+   item="%s"
+   revision="6643">
+</wc-status>
+</entry>
+'''
+            status = '''<?xml version="1.0"?>
+<status>
+<target
+   path="%s">
+%s</target>
+</status>
+''' % (tmp, ''.join(entry % (os.path.join(tmp, path), item)
+                for path, item in (('new', 'added'), ('new/a.py', 'added'),
+                    ('b.py', 'added'), ('c.py', 'modified'))))
+            commands = []
+            svn_rebase.call = lambda cmd: commands.append(cmd) or status
+            removed = []
+            remove = os.remove
+            rmtree = shutil.rmtree
+            def record_remove(path):
+                removed.append(path)
+                remove(path)
+            def record_rmtree(path):
+                removed.append(path)
+                rmtree(path)
+            os.remove = record_remove
+            shutil.rmtree = record_rmtree
+            try:
+                svn_rebase.svn_revert(tmp)
+            finally:
+                os.remove = remove
+                shutil.rmtree = rmtree
+            self.assertEqual(commands, [
+                ['svn', 'status', '--xml', tmp],
+                ['svn', 'revert', '-R', tmp],
+                ])
+            self.assertEqual(removed, [os.path.join(tmp, path)
+                for path in ('new/a.py', 'new', 'b.py')])
+            self.assertEqual(os.listdir(tmp), ['c.py'])
+
+            commands[:] = []
+            svn_rebase.call = lambda cmd: commands.append(cmd) or (
+                    '''<?xml version="1.0"?>
+<status>
+<target
+   path=".">
+</target>
+</status>
+''')
+            svn_rebase.svn_revert()
+            self.assertEqual(commands, [
+                ['svn', 'status', '--xml', '.'],
+                ['svn', 'revert', '-R', '.'],
+                ])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_has_conflicts(self):
+        status = '''<?xml version="1.0"?>
+<status>
+<target
+   path=".">
+<entry
+   path="a.py">
+<wc-status
+   props="none"
+   item="%s"
+   revision="6643"%s>
+</wc-status>
+</entry>
+</target>
+</status>
+'''
+        svn_rebase.call = lambda cmd: status % ('modified', '')
+        self.assertFalse(svn_rebase.has_conflicts())
+        svn_rebase.call = lambda cmd: status % ('conflicted', '')
+        self.assertTrue(svn_rebase.has_conflicts())
+        svn_rebase.call = lambda cmd: status % (
+                'missing', '\n   tree-conflicted="true"')
+        self.assertTrue(svn_rebase.has_conflicts('dir'))
+
+    def test_svn_rebase_deferred_not_deferred_again(self):
+        self.rebase_setup([2], {
+            2: set(['/trunk/b']),
+            3: set(['/trunk/c.py']),
+            })
+        try:
+            svn_rebase.svn_rebase('source', [2, 3], defer_conflicts=True,
+                    deferred=[2])
+        except SystemExit:
+            pass
+        self.assertEqual(self.merged, [])
+        self.assertFalse(svn_rebase.svn_revert.called)
+        self.assertEqual(svn_rebase.save_state.call_args[0],
+                ('source', [3], None))
+
+    def test_svn_rebase_coalesce(self):
+        self.rebase_setup([], dict((r, []) for r in range(1, 8)))
+        svn_rebase.merge_is_clean = lambda source, revisions, destination: (
+                4 not in revisions)
+        self.merged_ranges = []
+        def svn_merge_range(source, revisions, destination, auto_commit,
+                hooks=None):
+            self.merged_ranges.append(revisions)
+            return 'message'
+        svn_rebase.svn_merge_range = svn_merge_range
+        svn_rebase.svn_rebase('source', coalesce=3)
+        # r4 does not merge cleanly with r5 and r6
+        self.assertEqual(self.merged_ranges, [[1, 2, 3], [5, 6, 7]])
+        self.assertEqual(self.merged, [4])
+
+    def test_svn_rebase_hooks(self):
+        self.rebase_setup([2], {1: [], 2: []})
+        events = []
+        hooks = svn_rebase.Hooks()
+        for event in svn_rebase.HOOK_EVENTS:
+            hooks.add(event, lambda event, source, revisions, message,
+                    committed: events.append((event, revisions)))
+        try:
+            svn_rebase.svn_rebase('source', hooks=hooks)
+        except SystemExit:
+            pass
+        self.assertEqual(events, [
+            ('pre-merge', [1]),
+            ('pre-merge', [2]),
+            ('on-conflict', [2]),
+            ])
+        self.assertEqual(hooks.threads, [])
+
+    def test_svn_rebase_several_sources(self):
+        self.rebase_setup([], {})
+        logs = {
+                'trunk': [10, 8, 5, 3],
+                'branch': [9, 7, 4],
+                }
+        svn_rebase.get_source_revisions = lambda source, stop_on_copy=False: (
+                list(logs[source]))
+        def svn_merge(source, revision, destination, auto_commit,
+                hooks=None):
+            self.merged.append((source, int(revision)))
+            return 'message'
+        svn_rebase.svn_merge = svn_merge
+        svn_rebase.svn_rebase(['trunk', 'branch'], ['3-8'])
+        self.assertEqual(self.merged, [
+            ('trunk', 3), ('branch', 4), ('trunk', 5), ('branch', 7),
+            ('trunk', 8), ('branch', 9)])
+        self.assertEqual(svn_rebase.save_state.call_args_list[2][0],
+                (['trunk', 'branch'], [[8], [7, 9]], None))
+
+    def test_svn_rebase_several_sources_defer_conflicts(self):
+        self.rebase_setup([], {})
+        logs = {
+                'trunk': [4, 2, 1],
+                'branch': [5, 3],
+                }
+        changed_paths = {
+                ('trunk', 1): set(['/trunk/x.py']),
+                ('trunk', 2): set(['/trunk/a.py']),
+                ('branch', 3): set(['/branches/f/a.py']),
+                ('trunk', 4): set(['/trunk/b.py']),
+                ('branch', 5): set(['/branches/f/c.py']),
+                }
+        svn_rebase.get_source_revisions = lambda source, stop_on_copy=False: (
+                list(logs[source]))
+        def get_changed_paths(revision, source):
+            start, end = (revision.split(':') * 2)[:2]
+            paths = set()
+            for r in range(int(start), int(end) + 1):
+                paths.update(changed_paths.get((source, r), []))
+            return paths
+        svn_rebase.get_changed_paths = get_changed_paths
+        svn_rebase.get_source_path = lambda source: {
+                'trunk': '/trunk', 'branch': '/branches/f'}[source]
+        def svn_merge(source, revision, destination, auto_commit,
+                hooks=None):
+            if (source, int(revision)) == ('trunk', 2):
+                raise svn_rebase.SvnConflictException
+            self.merged.append((source, int(revision)))
+            return 'message'
+        svn_rebase.svn_merge = svn_merge
+        try:
+            svn_rebase.svn_rebase(['trunk', 'branch'], defer_conflicts=True)
+        except SystemExit:
+            pass
+        # branch r3 changes the same file as the deferred trunk r2
+        self.assertEqual(self.merged, [('trunk', 1)])
+        self.assertEqual(svn_rebase.cache_changed_paths.call_args_list, [
+            (('2:4', 'trunk'), {}),
+            (('3:5', 'branch'), {}),
+            ])
+        self.assertEqual(svn_rebase.save_state.call_args[0],
+                (['trunk', 'branch'], [[2, 4], [3, 5]], None))
+        self.assertEqual(svn_rebase.save_state.call_args[1]['deferred'], [2])
+
+    def test_svn_rebase_coalesce_conflict_in_run(self):
+        self.rebase_setup([], dict((r, []) for r in range(1, 9)))
+        dry_runs = []
+        def merge_is_clean(source, revisions, destination):
+            dry_runs.append(revisions)
+            return 6 not in revisions
+        svn_rebase.merge_is_clean = merge_is_clean
+        self.merged_ranges = []
+        def svn_merge_range(source, revisions, destination, auto_commit,
+                hooks=None):
+            self.merged_ranges.append(revisions)
+            return 'message'
+        svn_rebase.svn_merge_range = svn_merge_range
+        svn_rebase.svn_rebase('source', coalesce=8)
+        self.assertEqual(dry_runs, [
+            [1, 2, 3, 4, 5, 6, 7, 8],
+            [1, 2, 3, 4],
+            [5, 6, 7, 8],
+            [5, 6],
+            [6, 7, 8],
+            [7, 8],
+            ])
+        self.assertEqual(self.merged_ranges[0], [1, 2, 3, 4])
+        self.assertEqual(self.merged, [5, 6])
+        self.assertEqual(self.merged_ranges[1:], [[7, 8]])
+
+    def test_svn_rebase_without_conflicts(self):
+        self.rebase_setup([], {
+            1: set(['/trunk/a.py']),
+            2: set(['/trunk/b']),
+            })
+        svn_rebase.svn_rebase('source', defer_conflicts=True)
+        self.assertEqual(self.merged, [1, 2])
+        self.assertTrue(svn_rebase.remove_state_file.called)
+
     def test_save_load_state(self):
         svn_rebase.save_state(
                 'https://svn_server/path',
@@ -103,6 +770,10 @@ class TestSvnRebase(unittest.TestCase):
             'revisions': [1, 2, 3],
             'destination': None,
             'auto_commit': False,
+            'defer_conflicts': False,
+            'deferred': None,
+            'coalesce': 1,
+            'hooks': None,
             })
 
     def test_load_state_non_existent(self):
@@ -167,6 +838,74 @@ class TestSvnRebase(unittest.TestCase):
             pass
         self.assertFalse(svn_rebase.svn_rebase.called)
 
+    def test_main_continue_with_defer_conflicts(self):
+        self.main_setup()
+        self.options.cont = True
+        self.options.defer_conflicts = True
+        svn_rebase.sys.argv = ['svn_rebase', '-c', '-D']
+        try:
+            svn_rebase.main()
+        except SystemExit:
+            pass
+        self.assertFalse(svn_rebase.svn_rebase.called)
+
+    def test_main_abort_with_defer_conflicts(self):
+        self.main_setup()
+        self.options.abort = True
+        self.options.defer_conflicts = True
+        svn_rebase.sys.argv = ['svn_rebase', '-a', '-D']
+        try:
+            svn_rebase.main()
+        except SystemExit:
+            pass
+        self.assertFalse(svn_rebase.remove_state_file.called)
+
+    def test_main_continue_with_coalesce(self):
+        self.main_setup()
+        self.options.cont = True
+        self.options.coalesce = 5
+        svn_rebase.sys.argv = ['svn_rebase', '-c', '-C5']
+        try:
+            svn_rebase.main()
+        except SystemExit:
+            pass
+        self.assertFalse(svn_rebase.svn_rebase.called)
+
+    def test_main_abort_with_coalesce(self):
+        self.main_setup()
+        self.options.abort = True
+        self.options.coalesce = 5
+        svn_rebase.sys.argv = ['svn_rebase', '-a', '-C5']
+        try:
+            svn_rebase.main()
+        except SystemExit:
+            pass
+        self.assertFalse(svn_rebase.remove_state_file.called)
+
+    def test_main_continue_with_hooks(self):
+        self.main_setup()
+        self.options.cont = True
+        self.options.hooks = ['post-commit:./notify.sh']
+        svn_rebase.sys.argv = ['svn_rebase', '-c', '-k',
+                'post-commit:./notify.sh']
+        try:
+            svn_rebase.main()
+        except SystemExit:
+            pass
+        self.assertFalse(svn_rebase.svn_rebase.called)
+
+    def test_main_abort_with_hooks(self):
+        self.main_setup()
+        self.options.abort = True
+        self.options.hooks = ['post-commit:./notify.sh']
+        svn_rebase.sys.argv = ['svn_rebase', '-a', '-k',
+                'post-commit:./notify.sh']
+        try:
+            svn_rebase.main()
+        except SystemExit:
+            pass
+        self.assertFalse(svn_rebase.remove_state_file.called)
+
     def test_main_abort(self):
         self.main_setup()
         self.options.abort = True
@@ -192,7 +931,7 @@ class TestSvnRebase(unittest.TestCase):
 
     def test_main(self):
         self.args = ['http://nohost/svn/']
-        self.options.revisions = '1234'
+        self.options.revisions = ['1234']
         self.options.destination = 'src'
         self.options.auto_commit = False
         self.main_setup()
@@ -204,8 +943,94 @@ class TestSvnRebase(unittest.TestCase):
             'revisions': '1234',
             'destination': 'src',
             'auto_commit': False,
+            'defer_conflicts': False,
+            'coalesce': 1,
+            'hooks': None,
             })
 
+    def test_main_several_sources(self):
+        self.args = ['http://nohost/svn/trunk', 'http://nohost/svn/branch']
+        self.options.revisions = ['1000-1005']
+        self.main_setup()
+        svn_rebase.sys.argv = ['svn_rebase', '-r1000-1005',
+                'http://nohost/svn/trunk', 'http://nohost/svn/branch']
+        svn_rebase.main()
+        self.assertEqual(svn_rebase.svn_rebase.call_args[1]['source'],
+                ['http://nohost/svn/trunk', 'http://nohost/svn/branch'])
+        self.assertEqual(svn_rebase.svn_rebase.call_args[1]['revisions'],
+                ['1000-1005'])
+
+    def test_main_several_sources_empty_revisions(self):
+        self.args = ['http://nohost/svn/trunk', 'http://nohost/svn/branch']
+        self.options.revisions = ['', '1000-1005']
+        self.main_setup()
+        svn_rebase.sys.argv = ['svn_rebase', '-r', '', '-r1000-1005',
+                'http://nohost/svn/trunk', 'http://nohost/svn/branch']
+        svn_rebase.main()
+        self.assertEqual(svn_rebase.svn_rebase.call_args[1]['revisions'],
+                [None, '1000-1005'])
+
+    def test_main_invalid_revisions(self):
+        self.args = ['http://nohost/svn/trunk']
+        self.options.revisions = ['1000-']
+        self.main_setup()
+        svn_rebase.sys.argv = ['svn_rebase', '-r1000-',
+                'http://nohost/svn/trunk']
+        try:
+            svn_rebase.main()
+        except SystemExit:
+            pass
+        self.assertTrue(svn_rebase.optparse.OptionParser.return_value
+                .error.called)
+        self.assertFalse(svn_rebase.svn_rebase.called)
+
+    def test_main_too_many_revisions(self):
+        self.args = ['http://nohost/svn/trunk']
+        self.options.revisions = ['1000-1005', '1008']
+        self.main_setup()
+        svn_rebase.sys.argv = ['svn_rebase', '-r1000-1005', '-r1008',
+                'http://nohost/svn/trunk']
+        try:
+            svn_rebase.main()
+        except SystemExit:
+            pass
+        self.assertFalse(svn_rebase.svn_rebase.called)
+
+    def test_main_hook_unknown_event(self):
+        self.args = ['http://nohost/svn/']
+        self.options.hooks = ['post-update:./notify.sh']
+        self.main_setup()
+        svn_rebase.sys.argv = ['svn_rebase', '-k', 'post-update:./notify.sh',
+                'http://nohost/svn/']
+        try:
+            svn_rebase.main()
+        except SystemExit:
+            pass
+        self.assertFalse(svn_rebase.svn_rebase.called)
+
+    def test_main_coalesce_less_than_one(self):
+        self.args = ['http://nohost/svn/']
+        self.options.coalesce = 0
+        self.main_setup()
+        svn_rebase.sys.argv = ['svn_rebase', '-C0', 'http://nohost/svn/']
+        try:
+            svn_rebase.main()
+        except SystemExit:
+            pass
+        self.assertFalse(svn_rebase.svn_rebase.called)
+
+    def test_main_defer_conflicts_with_manual_commit(self):
+        self.args = ['http://nohost/svn/']
+        self.options.auto_commit = False
+        self.options.defer_conflicts = True
+        self.main_setup()
+        svn_rebase.sys.argv = ['svn_rebase', '-m', '-D', 'http://nohost/svn/']
+        try:
+            svn_rebase.main()
+        except SystemExit:
+            pass
+        self.assertFalse(svn_rebase.svn_rebase.called)
+
 
 if __name__ == '__main__':
     unittest.main()